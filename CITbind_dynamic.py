@@ -69,11 +69,6 @@ def rename_files_in_folder(folder_path):
     else:
         raise FileNotFoundError("Required files not found: 'Analog*.csv' and/or 'merged_data.csv'.")
 
-def convert_time_to_seconds(time_str):
-    """Convert time in format 'MM:SS.s' to total seconds."""
-    minutes, seconds = time_str.split(':')
-    return int(minutes) * 60 + float(seconds)
-
 def combine_and_plot(folder_path, neuron_count):
     """Combine temperature and calcium imaging data and generate plots."""
     folder_name = os.path.basename(folder_path)
@@ -81,8 +76,11 @@ def combine_and_plot(folder_path, neuron_count):
     # Rename files and get new file paths
     data_file, temp_file = rename_files_in_folder(folder_path)
 
-    # Load data
-    data_df = pd.read_csv(data_file, engine='python', skipfooter=12)
+    # Load data: count the lines first so the C parser can stop before the 12-line footer
+    # (skipfooter is only supported by the much slower python engine)
+    with open(data_file, 'rb') as f:
+        line_count = sum(1 for _ in f)
+    data_df = pd.read_csv(data_file, nrows=line_count - 1 - 12)
     temp_df = pd.read_csv(temp_file, skiprows=6)
 
     # Validate neuron count
@@ -99,12 +97,15 @@ def combine_and_plot(folder_path, neuron_count):
     cbind_df = pd.DataFrame()
     cbind_df['POSITION_T'] = data_df['POSITION_T']
     cbind_df['tt'] = (cbind_df['POSITION_T'] * tmax / data_df['POSITION_T'].max()).round().astype(int)
-    cbind_df['Time (s)'] = cbind_df['tt'].apply(
-        lambda x: temp_df[temp_df['Sample'] == x]['Time (s)'].values[0] if x in temp_df['Sample'].values else None)
-    cbind_df['Time (s)'] = cbind_df['Time (s)'].apply(convert_time_to_seconds)
-    cbind_df['Time (s)'] = cbind_df['Time (s)'].astype(int)
-    cbind_df['Temperature(°C)'] = cbind_df['tt'].apply(
-        lambda x: temp_df[temp_df['Sample'] == x]['AI0 (°C)'].values[0] if x in temp_df['Sample'].values else None)
+
+    # Look up time and temperature for every 'tt' sample through a hash index on 'Sample'
+    temp_by_sample = temp_df.set_index('Sample')
+    cbind_df['Time (s)'] = temp_by_sample['Time (s)'].reindex(cbind_df['tt']).to_numpy()
+    cbind_df['Temperature(°C)'] = temp_by_sample['AI0 (°C)'].reindex(cbind_df['tt']).to_numpy()
+
+    # Convert time in format 'MM:SS.s' to total seconds for the whole column at once
+    minutes_seconds = cbind_df['Time (s)'].str.split(':', expand=True)
+    cbind_df['Time (s)'] = (minutes_seconds[0].astype(int) * 60 + minutes_seconds[1].astype(float)).astype(int)
 
     for col in neuron_columns:
         cbind_df[col] = data_df[col]
@@ -118,49 +119,50 @@ def combine_and_plot(folder_path, neuron_count):
     x_max = cbind_df['Time (s)'].max()
     x_ticks = [0, 30, 60, 90, 120, 150, 180, 210]
 
-    # Generate both plots
-    for idx, y_range in enumerate([None, (-1, 10)]):
-        fig = plt.figure(figsize=(10, 6))
-        gs = fig.add_gridspec(2, 1, height_ratios=[2, 1], hspace=0)
-        ax1 = fig.add_subplot(gs[0])
-        ax2 = fig.add_subplot(gs[1], sharex=ax1)
+    # Build the figure once; both plots share it
+    fig = plt.figure(figsize=(10, 6))
+    gs = fig.add_gridspec(2, 1, height_ratios=[2, 1], hspace=0)
+    ax1 = fig.add_subplot(gs[0])
+    ax2 = fig.add_subplot(gs[1], sharex=ax1)
 
-        neuron_colors = ['red', 'blue', 'green', 'purple', 'orange']
+    neuron_colors = ['red', 'blue', 'green', 'purple', 'orange']
 
-        for i, col in enumerate(neuron_columns):
-            color = neuron_colors[i % len(neuron_colors)]
-            ax1.plot(cbind_df['Time (s)'], cbind_df[col], marker='o', color=color, label=col)
-        ax1.axhline(y=0, color='black', linewidth=0.8)
-        ax1.set_ylabel('ΔF/F0')
-        ax1.legend(loc='upper right', frameon=False)
+    for i, col in enumerate(neuron_columns):
+        color = neuron_colors[i % len(neuron_colors)]
+        ax1.plot(cbind_df['Time (s)'], cbind_df[col], marker='o', color=color, label=col)
+    ax1.axhline(y=0, color='black', linewidth=0.8)
+    ax1.set_ylabel('ΔF/F0')
+    ax1.legend(loc='upper right', frameon=False)
 
-        ax2.plot(cbind_df['Time (s)'], cbind_df['Temperature(°C)'], marker='o', color='black', label='Temperature')
-        ax2.set_xlabel('Time (s)')
-        ax2.set_ylabel('Temperature (°C)')
-        ax2.legend(loc='upper right', frameon=False)
+    ax2.plot(cbind_df['Time (s)'], cbind_df['Temperature(°C)'], marker='o', color='black', label='Temperature')
+    ax2.set_xlabel('Time (s)')
+    ax2.set_ylabel('Temperature (°C)')
+    ax2.legend(loc='upper right', frameon=False)
 
-        ax2.set_ylim(10, 30)
+    ax2.set_ylim(10, 30)
 
-        if y_range:
-            ax1.set_ylim(y_range)
+    ax1.set_xlim(0, x_max)
+    ax2.set_xlim(0, x_max)
 
-        ax1.set_xlim(0, x_max)
-        ax2.set_xlim(0, x_max)
+    ax1.set_xticks(x_ticks)
+    ax2.set_xticks(x_ticks)
 
-        ax1.set_xticks(x_ticks)
-        ax2.set_xticks(x_ticks)
+    for line_position in x_ticks:
+        ax1.axvline(x=line_position, color='black', linestyle='--', linewidth=0.8)
+        ax2.axvline(x=line_position, color='black', linestyle='--', linewidth=0.8)
 
-        for line_position in x_ticks:
-            ax1.axvline(x=line_position, color='black', linestyle='--', linewidth=0.8)
-            ax2.axvline(x=line_position, color='black', linestyle='--', linewidth=0.8)
+    fig.suptitle(f"{folder_name}", fontsize=14)
 
-        fig.suptitle(f"{folder_name}", fontsize=14)
+    # Save both plots: the second one only changes the ΔF/F0 y-axis range
+    for idx, y_range in enumerate([None, (-1, 10)]):
+        if y_range:
+            ax1.set_ylim(y_range)
 
         output_pdf = os.path.join(folder_path, f'{folder_name}-cbind{idx}.pdf')
-        plt.savefig(output_pdf, format='pdf')
+        fig.savefig(output_pdf, format='pdf')
         print(f"Plot saved to {output_pdf}")
 
-        plt.close()
+    plt.close(fig)
 
 def main():
     parser = argparse.ArgumentParser(description="Combine temperature and calcium imaging data.")
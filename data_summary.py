@@ -4,6 +4,12 @@ import matplotlib.pyplot as plt
 from matplotlib.colors import LinearSegmentedColormap
 import sys
 import os
+from utility import nan_mean_and_sem
+
+# Row-wise mean and SEM of all columns except the first (time) column, ignoring NaN like
+# DataFrame.mean/.sem, computed with NumPy reductions on one float32 array
+def mean_and_sem(df):
+    return nan_mean_and_sem(df.iloc[:, 1:].to_numpy(dtype=np.float32))
 
 # Check if the user provided two CSV file paths
 if len(sys.argv) != 3:
@@ -43,12 +49,10 @@ else:
     sys.exit(1)
 
 # Calculate mean and SEM for temperature data
-mean_temp = df_temp.iloc[:, 1:].mean(axis=1)
-sem_temp = df_temp.iloc[:, 1:].sem(axis=1)
+mean_temp, sem_temp = mean_and_sem(df_temp)
 
 # Calculate mean and SEM for neuron response data
-mean_neuron = df_neuron.iloc[:, 1:].mean(axis=1)
-sem_neuron = df_neuron.iloc[:, 1:].sem(axis=1)
+mean_neuron, sem_neuron = mean_and_sem(df_neuron)
 
 # Increase all font sizes
 plt.rcParams.update({'font.size': 16})
@@ -12,6 +12,7 @@ Usage: python Generate_background.py /path/to/background_i.xlsx
 """
 
 import pandas as pd
+import numpy as np
 import os
 import sys
 
@@ -29,8 +30,13 @@ def generate_background(file_path):
     # Read the Excel file
     df = pd.read_excel(file_path, engine='openpyxl')
 
+    # Store neuron names as categories and stack values as float32 to make the groupby lighter
+    df['Neurons'] = df['Neurons'].astype('category')
+    stack_columns = df.columns.drop('Neurons')
+    df[stack_columns] = df[stack_columns].astype('float32')
+
     # Calculate mean for each stack in each neuron, ignoring NaN values
-    means = df.groupby('Neurons').mean()
+    means = df.groupby('Neurons', observed=True).mean()
 
     # Drop all stacks with no input
     non_empty_stacks = means.dropna(axis=1, how='all')
@@ -38,11 +44,18 @@ def generate_background(file_path):
     # Transpose and reset index to start the stack means right under the neuron names
     transposed = non_empty_stacks.transpose().reset_index(drop=True)
 
-    # Ensure that all data starts right under the column names, no empty cells
-    transposed = transposed.apply(lambda x: pd.Series(x.dropna().values), axis=0).fillna('')
-
-    # Generate the CSV file
-    transposed.to_csv(output_file_path, index=False)
+    # Ensure that all data starts right under the column names, no empty cells:
+    # move each column's non-empty values to the top, then trim the rows left empty in every column
+    values = transposed.to_numpy()
+    non_empty = ~np.isnan(values)
+    packed = np.full_like(values, np.nan)
+    for j in range(values.shape[1]):
+        column_values = values[non_empty[:, j], j]
+        packed[:len(column_values), j] = column_values
+    transposed = pd.DataFrame(packed[:non_empty.sum(axis=0).max(initial=0)], columns=transposed.columns)
+
+    # Generate the CSV file, leaving missing values as empty cells
+    transposed.to_csv(output_file_path, index=False, na_rep='')
 
     return output_file_path
 
@@ -19,144 +19,119 @@ updated by Hua Bai at March 14 2024, adding more error messages
 """
 
 import os # Handles file and directory operations.
-import shutil # Manages high-level file operations, such as deleting directories.
-import matplotlib.pyplot as plt # For plotting graphs
+from concurrent.futures import ProcessPoolExecutor # Runs the neurons in parallel worker processes.
+from matplotlib.figure import Figure # For plotting graphs without pyplot's global figure registry
 import pandas as pd # For handling tabular data (e.g., reading/writing CSV files)
 import numpy as np # For numerical operations (e.g., creating arrays, mathematical calculations).
 from matplotlib.ticker import MaxNLocator #  Ensures that x-axis labels are integers in plots.
+from utility import read_csv_columns, write_csv, read_background_list, fill_time_points, subtract_background_max, PARQUET_AVAILABLE # CSV reader/writer (pyarrow when available), Background_list.csv reader, background subtraction kernel (numba when available).
+
+# define function check_output_format
+# Validates output_format before any neuron is processed; "parquet" needs pyarrow.
+def check_output_format(output_format):
+    if output_format not in ("csv", "parquet"):
+        raise ValueError(f"Unsupported output format: {output_format}. Use 'csv' or 'parquet'.")
+    if output_format == "parquet" and not PARQUET_AVAILABLE:
+        raise ImportError("output_format='parquet' needs pyarrow: python -m pip install pyarrow")
+
+# define function resolve_results_folder
+# Returns the folder the results of one neuron are written to:
+# the default "results" lives in parent_dir (the folder holding the Neuron folders),
+# any other (relative) results_folder is resolved against the neuron's working_dir.
+def resolve_results_folder(working_dir, results_folder, parent_dir):
+    if results_folder == "results":
+        return os.path.join(parent_dir, results_folder)
+    return os.path.join(working_dir, results_folder)
 
 # define function fluorescence_extract
 # Processes fluorescence data for one neuron.
 # Takes several arguments:
 # working_dir: Directory containing CSV files.
-# results_folder: Folder to save results (default: "results").
+# results_folder: Folder to save results (default: "results"), resolved with resolve_results_folder;
+#                 an absolute path is used as it is.
 # trial_name: Name of the neuron or experiment (default: "Neuron").
 # position_t: Number of time points (default: 100).
 # background_averages: Background fluorescence values for subtraction (default: [1]).
+# output_format: "csv" or "parquet" (snappy-compressed, needs pyarrow) for the per-neuron result (default: "csv").
 def fluorescence_extract(working_dir,
                         results_folder = "results", 
                         trial_name = "Neuron", 
                         position_t=100, 
-                        background_averages=[1]):
+                        background_averages=[1],
+                        output_format="csv"):
 
-    # Change working directory to working_dir
-    # Remove and recreate a temporary directory (python_files) to store intermediate results.
-    os.chdir(working_dir)
-    output_path = os.path.join(working_dir, 'python_files')
-    
-    if os.path.exists(output_path):
-        shutil.rmtree(output_path)
-    
-    os.mkdir('python_files')
+    check_output_format(output_format)
 
     # create a POSITION_T Column
-    position_t_column = np.arange(0,position_t) # Generate an array from 0 to position_t-1 to represent time points
-    position_t_array = pd.DataFrame(position_t_column, columns=['POSITION_T']) # Convert the array into a DataFrame (position_t_array) with the column name POSITION_T.
-    
-    POSITION_T_path = os.path.join(output_path, "POSITION_T.csv") # Save this DataFrame to a CSV file (POSITION_T.csv) in the temporary directory.
-    position_t_array.to_csv(POSITION_T_path, index=False)
-
+    position_t_column = np.arange(0,position_t, dtype=np.int32) # Generate an int32 array from 0 to position_t-1 to represent time points
 
     # Process input files.
-    # Loop through files in working_dir:
-    # Process only .csv files that don’t start with ~$ (avoids temporary files).
-    # Extract relevant columns (POSITION_T and MEAN_INTENSITY_CH1) from each file.
-    # Rename columns for clarity (MEAN_INTENSITY_CH1 → filename).
-    # Save processed data to a temporary file in python_files.
-
-    for filename in os.listdir(working_dir):
-        if filename.endswith(".csv") and not filename.startswith("~$"):
-            try:
-                df = pd.read_csv(filename, usecols=(["POSITION_T","MEAN_INTENSITY_CH1"]))
-                file_name = os.path.splitext(filename)[0]
-                df.columns = ['POSITION_T', file_name]
-                df.to_csv(f"python_files/{file_name}py.csv", index=False, na_rep='')
-            except Exception as e:
-                print(f"Error processing file {full_file_path}: {e}")
-                continue
+    # List the .csv files in working_dir once, skipping those that start with ~$ (avoids temporary files),
+    # sorted by file name so the columns line up with background_averages.
+    csv_files = sorted((filename for filename in os.listdir(working_dir)
+                        if filename.endswith(".csv") and not filename.startswith("~$")),
+                       key=lambda filename: os.path.splitext(filename)[0])
 
     # Merge Data by POSITION_T
-    # Merge files:
-    # Start with POSITION_T.csv as the base.
-    # Sequentially merge each py.csv file, aligning by POSITION_T.
-    # Save the merged result back to POSITION_T.csv and delete the temporary file.
-    for filename in os.listdir(output_path):
-        if filename.endswith("py.csv"):
-            try:
-                POSITION_T = pd.read_csv(POSITION_T_path, na_values='')
-                data = os.path.join(output_path, filename)
-                df = pd.read_csv(data)
-                joined = POSITION_T.merge(df, on = "POSITION_T", how='left')
-                joined.to_csv(POSITION_T_path,index=False, na_rep='')
-                os.remove(data)
-            except Exception as e:
-                print(f"Error processing file {full_file_path}: {e}")
-                continue
+    # Preallocate one float32 array (time points x files), NaN where a file has no value for a time point.
+    # Extract relevant columns (POSITION_T and MEAN_INTENSITY_CH1) from each file and write
+    # MEAN_INTENSITY_CH1 straight into that file's column, at the rows given by POSITION_T.
+    data = np.full((position_t, len(csv_files)), np.nan, dtype=np.float32)
+    spot_columns = []
+    for filename in csv_files:
+        try:
+            df = read_csv_columns(os.path.join(working_dir, filename), ["POSITION_T","MEAN_INTENSITY_CH1"], dtype={"MEAN_INTENSITY_CH1": "float32"})
+            fill_time_points(data, len(spot_columns), df["POSITION_T"].to_numpy(), df["MEAN_INTENSITY_CH1"].to_numpy())
+            spot_columns.append(os.path.splitext(filename)[0])
+        except Exception as e:
+            print(f"Error processing file {filename}: {e}")
+            continue
+    data = np.ascontiguousarray(data[:, :len(spot_columns)]) # Drop the columns of files that could not be read.
 
     # Background Subtraction
-    # Read the merged data and sort columns alphabetically.
-    # Adjust column order to place POSITION_T first.
-    # Perform background subtraction using background_averages.
-    subtract_averages = pd.read_csv(POSITION_T_path, na_values='')
-    subtract_averages_sort = subtract_averages.reindex(sorted(subtract_averages.columns), axis=1)
-    cols = list(subtract_averages_sort.columns)
-    cols = [cols[-1]] + cols[:-1] # move the last column 'position_T' to the first
-    subtract_averages = subtract_averages_sort[cols]
-    Averages = [0]
-    for i in background_averages:
-        Averages.append(i)
-
-    subtract_averages = subtract_averages - Averages
-    subtract_averages.to_csv(f"python_files/{trial_name}_subtracted_averages.csv", index=False, na_rep="")
+    # Perform background subtraction using background_averages on the float32 array of spot columns,
+    # and find the maximum fluorescence intensity for each time point in the same pass.
+    background = np.asarray(background_averages, dtype=np.float32)
+    if background.shape != (len(spot_columns),):
+        raise ValueError(f"{trial_name}: {len(spot_columns)} spot files but {background.size} background values.")
+    max_value = subtract_background_max(data, background)
 
     # Compute Δ𝐹/F0
-    # Find the maximum fluorescence intensity for each time point.
-    # Compute baseline fluorescence (F0) as the first value of max_value
-    # Calculate Δ𝐹/F0 using the formula and add it to the DataFrame.
-    max_value = subtract_averages.drop('POSITION_T', axis=1)
-    max_value = max_value.max(axis=1)
-    subtract_averages['max_value'] = max_value
-    subtract_averages.to_csv(f"python_files/{trial_name}_max_value.csv", index=False, na_rep="")
-    
-    first_neuron_POSITION_T = subtract_averages['max_value'].first_valid_index()
-    Fo = max_value[first_neuron_POSITION_T]
+    # Compute baseline fluorescence (F0) as the first finite value of max_value
+    # Calculate Δ𝐹/F0 using the formula.
+    first_valid = int(np.isfinite(max_value).argmax())
+    Fo = max_value[first_valid]
     dF = (max_value-Fo)/Fo
+
+    # Build the output DataFrame once: POSITION_T first, then the spot columns in file-name order,
+    # then max_value and dF/F0.
+    subtract_averages = pd.DataFrame(data, columns=spot_columns)
+    subtract_averages.insert(0, "POSITION_T", position_t_column)
+    subtract_averages['max_value'] = max_value
     subtract_averages['dF/F0'] = dF
-    file_name = os.path.splitext(filename)[0]
 
     # Save results and generate plot
     # Save the final processed data and plot Δ𝐹/F0 vs POSITION_T
-    subtract_averages.to_csv(f"python_files/{trial_name}_dF_F0.csv", index=False, na_rep="")
+    results_folder = resolve_results_folder(working_dir, results_folder, os.path.dirname(working_dir))
+    plots_folder = os.path.join(results_folder, "Neuron Plots")
+    os.makedirs(plots_folder, exist_ok=True)
 
-    if results_folder == "results":
-        new_path = os.path.dirname(working_dir)
-        try:
-            os.mkdir(f"{new_path}/{results_folder}")
-        except:
-            pass
-        results_folder = f"{new_path}/{results_folder}"
-        
+    if output_format == "parquet":
+        subtract_averages.to_parquet(f"{results_folder}/{trial_name}.parquet", engine="pyarrow", compression="snappy", index=False)
     else:
-        
-        try:
-            os.mkdir(results_folder)
-            print("Created: " + results_folder)
-        except:
-            print('Results folder exists')
-        
-    subtract_averages.to_csv(f"{results_folder}/{trial_name}.csv", index=False, na_rep="")
+        write_csv(subtract_averages, f"{results_folder}/{trial_name}.csv")
     
-    average_plot = subtract_averages.plot.line(x="POSITION_T", y="dF/F0", legend=False, title=trial_name)
+    # Build the plot as a standalone Figure (rendered by Agg on save), so nothing is kept in pyplot's
+    # figure registry and no GUI backend is started, also inside worker processes.
+    fig = Figure()
+    average_plot = fig.subplots()
+    average_plot.plot(subtract_averages["POSITION_T"], subtract_averages["dF/F0"])
+    average_plot.set_title(trial_name)
     average_plot.set_xlabel("Position T")
     average_plot.set_ylabel("\u0394F/F0")
     average_plot.xaxis.set_major_locator(MaxNLocator(integer=True))
-    
-    try:
-        os.mkdir(f"{results_folder}/Neuron Plots")
-    except:
-        pass
-                 
-    plt.savefig(f"{results_folder}/Neuron Plots/{trial_name}.png", bbox_inches="tight")
+
+    fig.savefig(f"{plots_folder}/{trial_name}.png", bbox_inches="tight")
 
 
 # Function: loop_fluorescence_extract
@@ -165,32 +140,39 @@ def loop_fluorescence_extract(working_dir,
                               background_file, 
                               number_of_position_t=100,
                               result_folder="results",
+                              output_format="csv",
                               ):
+    check_output_format(output_format)
+
     # Background Data Processing
     # Reads a background file containing baseline values for each neuron.
     # Constructs a list of background averages for each neuron.
-    background_file = pd.read_csv(background_file, keep_default_na=False)
-    number_of_neurons = len(background_file.columns)
-    
-    background_averages_list = []
-    
-    for i in range(0,number_of_neurons):
-        column_name = f"Neuron {i}"
-        list1 = background_file.loc[~background_file[column_name].astype(str).str.isdigit(), column_name].tolist()
-        list2 = []
-        for x in list1:
-            try:
-                float_list = float(x)
-                list2.append(float_list)
-            except:
-                pass
-        background_averages_list.append(list2)
+    background_averages_list = read_background_list(background_file)
+    number_of_neurons = len(background_averages_list)
 
-    # Call fluorescence_extract for Each Neuron
-    # Iterates over neurons, calling fluorescence_extract for each neuron’s directory and background values.
+    # Skip placeholder neurons whose folder is missing or holds no .csv files,
+    # so they never reach the read/merge/plot pipeline.
+    neurons = []
     for i in range(0, number_of_neurons):
-        fluorescence_extract(f'{working_dir}/Neuron {i}',
-                             trial_name=f"Neuron {i}",
-                             position_t=number_of_position_t,
-                             background_averages=background_averages_list[i],
-                             results_folder=result_folder )
+        neuron_dir = f'{working_dir}/Neuron {i}'
+        if not os.path.isdir(neuron_dir) or not any(f.endswith(".csv") for f in os.listdir(neuron_dir)):
+            print(f"Skipping Neuron {i}: no .csv files found in {neuron_dir}")
+            continue
+        neurons.append(i)
+
+    # Resolve each neuron's results folder once, as an absolute path, before dispatching the neurons.
+    # The default "results" folder is shared by all neurons; any other result_folder lives in each neuron's folder.
+    results_folders = [os.path.abspath(resolve_results_folder(f'{working_dir}/Neuron {i}', result_folder, working_dir)) for i in neurons]
+
+    # Call fluorescence_extract for Each Neuron
+    # Neurons are independent, so they are processed in parallel worker processes,
+    # each with its own neuron’s directory and background values.
+    # The default pool size is one worker per CPU (capped at 61 on Windows, where more would fail).
+    with ProcessPoolExecutor() as executor:
+        list(executor.map(fluorescence_extract,
+                          [f'{working_dir}/Neuron {i}' for i in neurons],
+                          results_folders,
+                          [f"Neuron {i}" for i in neurons],
+                          [number_of_position_t] * len(neurons),
+                          [background_averages_list[i] for i in neurons],
+                          [output_format] * len(neurons)))
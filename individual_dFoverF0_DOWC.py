@@ -17,11 +17,33 @@ The loop_fluorescence_extract_DOWC() function batch-processes multiple neurons i
 """
 
 import os  # Handles file and directory operations.
-import shutil  # Manages high-level file operations, such as deleting directories.
-import matplotlib.pyplot as plt  # For plotting graphs
+from concurrent.futures import ProcessPoolExecutor  # Runs the neurons in parallel worker processes.
+from matplotlib.figure import Figure  # For plotting graphs without pyplot's global figure registry
 import pandas as pd  # For handling tabular data (e.g., reading/writing CSV files)
 import numpy as np  # For numerical operations (e.g., creating arrays, mathematical calculations)
 from matplotlib.ticker import MaxNLocator  # Ensures x-axis labels are integers in plots.
+from utility import read_csv_columns, write_csv, read_background_list, fill_time_points, subtract_background_max  # CSV reader/writer, Background_list.csv reader, column fill by POSITION_T and background subtraction kernel.
+
+# Plot template shared by all neurons plotted in the same process: the Figure, its axes, the axis labels
+# and the integer locator are built once and reused, only the line and title change per neuron.
+# It is cached per process because axes cannot be sent to the worker processes.
+_plot_template = None
+
+def _neuron_plot_axes():
+    global _plot_template
+    if _plot_template is None:
+        fig = Figure()
+        ax = fig.subplots()
+        ax.set_xlabel("Position T")
+        ax.set_ylabel("\u0394F/F0")
+        ax.xaxis.set_major_locator(MaxNLocator(integer=True))
+        _plot_template = (fig, ax)
+    fig, ax = _plot_template
+    for line in list(ax.lines):
+        line.remove()  # Remove the previous neuron's line and forget its data limits.
+    ax.relim()
+    ax.set_prop_cycle(None)  # Start the color cycle over, so every neuron is drawn in the first color.
+    return fig, ax
 
 # This function processes fluorescence data for one neuron
 def fluorescence_extract_DOWC(working_dir,
@@ -33,85 +55,71 @@ def fluorescence_extract_DOWC(working_dir,
     Parameters:
         working_dir: Directory containing CSV files for a single neuron.
         results_folder: Folder to save processed results (default: "results").
+                        A relative path is resolved against working_dir.
         trial_name: Name for the output files (default: "Neuron").
         position_t: Number of time points (default: 100).
         background_averages: Background fluorescence values for subtraction (default: [1]).
     """
-    # Step 1: Change to the working directory and create a temporary folder for intermediate files.
-    os.chdir(working_dir)
-    output_path = os.path.join(working_dir, 'python_files')
-    if os.path.exists(output_path):
-        shutil.rmtree(output_path)  # Clear the temporary folder if it already exists.
-    os.mkdir('python_files')
-
-    # Step 2: Create a DataFrame for POSITION_T (time points) and save it as a CSV file.
-    position_t_column = np.arange(0, position_t)  # Create an array of integers from 0 to position_t-1.
-    position_t_array = pd.DataFrame(position_t_column, columns=['POSITION_T'])  # Convert array to a DataFrame.
-    POSITION_T_path = os.path.join(output_path, "POSITION_T.csv")
-    position_t_array.to_csv(POSITION_T_path, index=False)
+    # Step 1: Resolve the results folder.
+    results_folder = os.path.join(working_dir, results_folder)  # A relative results_folder is relative to working_dir.
+
+    # Step 2: Create the POSITION_T time points as an index (integers from 0 to position_t-1).
+    position_t_index = pd.Index(np.arange(0, position_t, dtype=np.int32), name='POSITION_T')
 
     # Step 3: Process input files (e.g., fluorescence intensity data from TrackMate output).
-    for filename in os.listdir(working_dir):
-        if filename.endswith(".csv") and not filename.startswith("~$"):  # Skip temporary files.
-            try:
-                # Read the POSITION_T and MEAN_INTENSITY_CH1 columns from the input file.
-                df = pd.read_csv(filename, usecols=["POSITION_T", "MEAN_INTENSITY_CH1"])
-                file_name = os.path.splitext(filename)[0]  # Extract the file name without extension.
-                df.columns = ['POSITION_T', file_name]  # Rename columns for clarity.
-                df.to_csv(f"python_files/{file_name}py.csv", index=False, na_rep='')
-            except Exception as e:
-                print(f"Error processing file {filename}: {e}")
-                continue
-
-    # Step 4: Merge all processed files based on POSITION_T.
-    for filename in os.listdir(output_path):
-        if filename.endswith("py.csv"):
-            try:
-                POSITION_T = pd.read_csv(POSITION_T_path, na_values='')
-                data = os.path.join(output_path, filename)
-                df = pd.read_csv(data)
-                joined = POSITION_T.merge(df, on="POSITION_T", how='left')  # Merge by POSITION_T.
-                joined.to_csv(POSITION_T_path, index=False, na_rep='')
-                os.remove(data)  # Clean up intermediate files after merging.
-            except Exception as e:
-                print(f"Error processing file {filename}: {e}")
-                continue
-
-    # Step 5: Perform background subtraction.
-    subtract_averages = pd.read_csv(POSITION_T_path, na_values='')
-    subtract_averages_sort = subtract_averages.reindex(sorted(subtract_averages.columns), axis=1)  # Sort columns.
-    cols = list(subtract_averages_sort.columns)
-    cols = [cols[-1]] + cols[:-1]  # Move POSITION_T to the first column.
-    subtract_averages = subtract_averages_sort[cols]
-
-    Averages = [0] + background_averages  # Prepend 0 for POSITION_T column.
-    subtract_averages = subtract_averages - Averages  # Subtract background averages.
-    subtract_averages.to_csv(f"python_files/{trial_name}_subtracted_averages.csv", index=False, na_rep="")
-
-    # Step 6: Compute ∆F/F0.
-    max_value = subtract_averages.drop('POSITION_T', axis=1).max(axis=1)  # Find the max fluorescence for each time point.
-    subtract_averages['max_value'] = max_value
-    subtract_averages.to_csv(f"python_files/{trial_name}_max_value.csv", index=False, na_rep="")
+    # The .csv files are listed in a single directory scan, skipping temporary files (~$) and folders,
+    # and sorted by file name so the columns line up with background_averages.
+    with os.scandir(working_dir) as entries:
+        csv_files = sorted((entry.name for entry in entries
+                            if entry.is_file() and entry.name.endswith(".csv") and not entry.name.startswith("~$")),
+                           key=lambda filename: os.path.splitext(filename)[0])
+
+    # Step 4: Combine all files by POSITION_T into one float32 array (time points x files), NaN where a file
+    # has no value for a time point. Each file's MEAN_INTENSITY_CH1 is written into its column at the rows
+    # given by POSITION_T, as in fluorescence_extract.
+    data = np.full((position_t, len(csv_files)), np.nan, dtype=np.float32)
+    spot_columns = []
+    for filename in csv_files:
+        try:
+            # Read the POSITION_T and MEAN_INTENSITY_CH1 columns from the input file.
+            df = read_csv_columns(os.path.join(working_dir, filename), ["POSITION_T", "MEAN_INTENSITY_CH1"], dtype={"MEAN_INTENSITY_CH1": "float32"})
+            fill_time_points(data, len(spot_columns), df["POSITION_T"].to_numpy(), df["MEAN_INTENSITY_CH1"].to_numpy())
+            spot_columns.append(os.path.splitext(filename)[0])  # Extract the file name without extension.
+        except Exception as e:
+            print(f"Error processing file {filename}: {e}")
+            continue
+    data = np.ascontiguousarray(data[:, :len(spot_columns)])  # Drop the columns of files that could not be read.
+
+    # Step 5: Prepare the background subtraction: one background value per spot column.
+    background = np.asarray(background_averages, dtype=np.float32)
+    if background.shape != (len(spot_columns),):
+        raise ValueError(f"{trial_name}: {len(spot_columns)} spot files but {background.size} background values.")
+
+    # Step 6: Subtract the background and find the max fluorescence for each time point in one pass
+    # (time points without any value stay NaN), then compute ∆F/F0.
+    max_value = subtract_background_max(data, background)
 
     # Modified: Use the minimum fluorescence value in POSITION_T 0 to 50 as F0.
-    min_region = subtract_averages[(subtract_averages['POSITION_T'] >= 0) & (subtract_averages['POSITION_T'] <= 50)]
-    Fo = min_region['max_value'].min()  # Find the minimum value in this range.
+    # POSITION_T runs 0..position_t-1 by row, so these are the first 51 rows.
+    Fo = np.fmin.reduce(max_value[:51])  # Find the minimum value in this range, skipping NaN.
     dF = (max_value - Fo) / Fo  # Calculate ∆F/F0.
+
+    # Build the DataFrame once, indexed by POSITION_T.
+    subtract_averages = pd.DataFrame(data, index=position_t_index, columns=spot_columns)
+    subtract_averages['max_value'] = max_value
     subtract_averages['dF/F0'] = dF
 
-    # Step 7: Save results and plot ∆F/F0 over time.
-    subtract_averages.to_csv(f"{results_folder}/{trial_name}.csv", index=False, na_rep="")
-    average_plot = subtract_averages.plot.line(x="POSITION_T", y="dF/F0", legend=False, title=trial_name)
-    average_plot.set_xlabel("Position T")
-    average_plot.set_ylabel("\u0394F/F0")
-    average_plot.xaxis.set_major_locator(MaxNLocator(integer=True))
+    # Step 7: Save results (POSITION_T as the first column) and plot ∆F/F0 over time.
+    write_csv(subtract_averages.reset_index(), os.path.join(results_folder, f"{trial_name}.csv"))
+    # The plot reuses this process's standalone Figure (rendered by Agg on save), so no GUI backend is started
+    # in the worker processes and the axes are only set up once.
+    fig, average_plot = _neuron_plot_axes()
+    average_plot.plot(subtract_averages.index, subtract_averages["dF/F0"])
+    average_plot.set_title(trial_name)
 
-    try:
-        os.mkdir(f"{results_folder}/Neuron Plots")
-    except:
-        pass
+    os.makedirs(os.path.join(results_folder, "Neuron Plots"), exist_ok=True)
 
-    plt.savefig(f"{results_folder}/Neuron Plots/{trial_name}.png", bbox_inches="tight")
+    fig.savefig(os.path.join(results_folder, "Neuron Plots", f"{trial_name}.png"), bbox_inches="tight")
 
 
 def loop_fluorescence_extract_DOWC(working_dir,
@@ -127,27 +135,17 @@ def loop_fluorescence_extract_DOWC(working_dir,
         number_of_position_t: Number of time points for each dataset (default: 100).
         result_folder: Folder to save processed results (default: "results").
     """
-    background_file = pd.read_csv(background_file, keep_default_na=False)
-    number_of_neurons = len(background_file.columns)
-
-    background_averages_list = []
-
     # Parse background averages for each neuron.
-    for i in range(number_of_neurons):
-        column_name = f"Neuron {i}"
-        list1 = background_file.loc[~background_file[column_name].astype(str).str.isdigit(), column_name].tolist()
-        list2 = []
-        for x in list1:
-            try:
-                list2.append(float(x))
-            except:
-                pass
-        background_averages_list.append(list2)
+    background_averages_list = read_background_list(background_file)
+    number_of_neurons = len(background_averages_list)
 
     # Process each neuron's data using fluorescence_extract_DOWC.
-    for i in range(number_of_neurons):
-        fluorescence_extract_DOWC(f'{working_dir}/Neuron {i}',
-                                  trial_name=f"Neuron {i}",
-                                  position_t=number_of_position_t,
-                                  background_averages=background_averages_list[i],
-                                  results_folder=result_folder)
+    # Neurons are independent, so they are processed in parallel worker processes
+    # (by default one per CPU, capped at 61 on Windows, where more would fail).
+    with ProcessPoolExecutor() as executor:
+        list(executor.map(fluorescence_extract_DOWC,
+                          [f'{working_dir}/Neuron {i}' for i in range(number_of_neurons)],
+                          [result_folder] * number_of_neurons,
+                          [f"Neuron {i}" for i in range(number_of_neurons)],
+                          [number_of_position_t] * number_of_neurons,
+                          background_averages_list))
@@ -14,8 +14,9 @@ The function performs the following:
 import os # Handles directory creation and file manipulation
 import pandas as pd # For data manipulation and reading/writing CSV files.
 import numpy as np # Provides numerical operations (e.g., creating arrays).
-import matplotlib.pyplot as plt # Used for creating plots.
+from matplotlib.figure import Figure # Used for creating plots, without pyplot's global figure registry.
 from matplotlib.ticker import MaxNLocator # Ensures x-axis labels are integers.
+from utility import read_csv_columns, write_csv, fill_time_points, nan_mean_and_sem # CSV reader/writer (pyarrow when available), column fill by POSITION_T, NaN-aware row mean/SEM.
 
 # defines a function <merge_data> that :
 # takes in three parameters:
@@ -31,58 +32,65 @@ def merge_data(results_folder, position_t=999, plot_title = 'Average \u0394F/F0'
     except:
         pass # Ignores errors if the directory already exists.
     
-    # Position T Array Initialization
-    position_t_column = np.arange(0,position_t) # Creates an array of integers from 0 to position_t - 1 (representing time points).
-    position_t_array = pd.DataFrame(position_t_column, columns = ['POSITION_T']) # Converts the array into a DataFrame with a column named POSITION_T.
+    # Position T Index Initialization
+    position_t_index = pd.Index(np.arange(0,position_t, dtype = np.int32), name = 'POSITION_T') # int32 integers from 0 to position_t - 1 (representing time points).
 
-    # Defines paths for the output files:
+    # Defines the path for the output file:
     output_file_path = f"{results_folder}/merged_data/merged_data.csv" # merged_data.csv: The final merged file.
-    POSITION_T_path = f"{results_folder}/merged_data/position_t.csv" # position_t.csv: Temporary file for the POSITION_T column.
-    position_t_array.to_csv(POSITION_T_path, index=False) # Writes the POSITION_T DataFrame to position_t.csv.
 
-    # Loops through csv files
-    for filename in os.listdir(results_folder):
-        if filename.endswith(".csv"): #Loops through all files in results_folder and processes only .csv files.
-            # Processing Each CSV
-            POSITION_T = pd.read_csv(POSITION_T_path) # Reads the POSITION_T file into a DataFrame.
-            data = f"{results_folder}/{filename}" # Constructs the path to the current CSV file.
-            column_name = os.path.splitext(filename)[0] # Extracts the filename (without extension) to use as the column name.
-
-            df = pd.read_csv(data, usecols=['dF/F0','POSITION_T']) # Reads the dF/F0 and POSITION_T columns from the current file.
-            df.rename(columns = {"dF/F0": column_name}, inplace = True) # Renames the dF/F0 column to the filename for identification.
-
-            joined = POSITION_T.merge(df, on = "POSITION_T", how='left') # Merges the current file's data with the POSITION_T column
-            joined.to_csv(POSITION_T_path,index=False, na_rep = "") # Updates the temporary POSITION_T_path file with the new merged data
-
-    # Final Merge and Calculations
-    merged_data = pd.read_csv(POSITION_T_path, na_values = '')
-    average_data = merged_data.drop('POSITION_T', axis=1) # Drops the POSITION_T column to calculate:
-    average_column = average_data.mean(axis=1) # average_column: Mean of dF/F0 across all files for each time point.
-    sem_column = average_data.sem(axis=1) # sem_column: Standard error of the mean for dF/F0.
-
-    # Sorts columns alphabetically and reorders them to place POSITION_T as the first column.
-    merged_data_sort = merged_data.reindex(sorted(merged_data.columns), axis=1)
-    cols = list(merged_data_sort.columns)
-    cols = [cols[-1]] + cols[:-1]
-    merged_data = merged_data_sort[cols]
-
-    # Writes the merged data to merged_data.csv.
-    merged_data.to_csv(output_file_path,index=False, na_rep = "")
+    # Lists the csv and parquet result files in a single directory scan (the merged_data and Neuron Plots folders are skipped),
+    # sorted by file name so the merged columns come out in alphabetical order.
+    with os.scandir(results_folder) as entries:
+        result_files = sorted((entry.name for entry in entries if entry.is_file() and entry.name.endswith((".csv", ".parquet"))),
+                              key = lambda filename: os.path.splitext(filename)[0])
+
+    # Each neuron must have a single result file: a .csv and a .parquet with the same name would become two columns
+    # of the same name and count that neuron twice in Average and SEM.
+    stems = [os.path.splitext(filename)[0] for filename in result_files]
+    conflicts = [filename for filename, stem in zip(result_files, stems) if stems.count(stem) > 1]
+    if conflicts:
+        raise ValueError(f"Found both .csv and .parquet results for the same neuron in {results_folder}: {conflicts}. "
+                         "Remove the outdated files and run merge_data again.")
+
+    # Loops through csv and parquet files
+    # Preallocates one float32 array (time points x files), NaN where a file has no value for a time point,
+    # and writes each file's dF/F0 straight into its column at the rows given by POSITION_T.
+    merged_array = np.full((position_t, len(result_files)), np.nan, dtype = np.float32)
+    column_names = []
+    for j, filename in enumerate(result_files):
+        # Processing Each result file
+        data = f"{results_folder}/{filename}" # Constructs the path to the current result file.
+        column_names.append(os.path.splitext(filename)[0]) # Uses the filename (without extension) as the column name for identification.
+
+        # Reads the dF/F0 and POSITION_T columns from the current file.
+        if filename.endswith(".parquet"):
+            df = pd.read_parquet(data, columns=['dF/F0','POSITION_T'])
+        else:
+            df = read_csv_columns(data, ['dF/F0','POSITION_T'], dtype = {'dF/F0': 'float32'})
+        fill_time_points(merged_array, j, df['POSITION_T'].to_numpy(), df['dF/F0'].to_numpy())
+
+    # Final Calculations
+    # Computes on the float32 array of all files, skipping missing values:
+    # average_column: Mean of dF/F0 across all files for each time point.
+    # sem_column: Standard error of the mean for dF/F0.
+    average_column, sem_column = nan_mean_and_sem(merged_array)
+
+    # Builds the merged table once; POSITION_T is the index.
+    merged_data_2 = pd.DataFrame(merged_array, index = position_t_index, columns = column_names)
 
     # Add Average and SEM
-    merged_data_2 = pd.read_csv(output_file_path) # Reads merged_data.csv back into a DataFrame.
     merged_data_2['Average'] = average_column # Adds columns for Average and SEM.
     merged_data_2['SEM'] = sem_column #Adds columns for Average and SEM.
 
-    merged_data_2.to_csv(output_file_path, index=False, na_rep="") # Saves the updated file back to merged_data.csv.
-
-    # Deletes the temporary position_t.csv.
-    os.remove(POSITION_T_path)
+    # Writes the merged data with Average and SEM to merged_data.csv (POSITION_T as the first column), once.
+    write_csv(merged_data_2.reset_index(), output_file_path)
 
     # Plot the Results
     # Creates a line plot of Average versus POSITION_T with error bars for SEM.
-    merged_plot = merged_data_2.plot.line(x="POSITION_T", y="Average", yerr="SEM", legend=False, title=plot_title)
+    # The plot is drawn on a standalone Figure (rendered by Agg on save), which is freed with the function.
+    fig = Figure()
+    merged_plot = merged_data_2.plot.line(y="Average", yerr="SEM", legend=False, title=plot_title, ax=fig.subplots())
     merged_plot.set_xlabel("Position T")
     merged_plot.set_ylabel("\u0394F/F0")
     merged_plot.xaxis.set_major_locator(MaxNLocator(integer=True))
-    plt.savefig(f"{results_folder}/merged_data/Average_dF_F0.png", bbox_inches="tight") #Saves the plot as Average_dF_F0.png in the merged_data folder.
+    fig.savefig(f"{results_folder}/merged_data/Average_dF_F0.png", bbox_inches="tight") #Saves the plot as Average_dF_F0.png in the merged_data folder.
@@ -4,7 +4,28 @@ This file contains shared functions for the project
 @author: VT Ni-Lab
 """
 import os
+import io
 import csv
+import warnings
+import numpy as np
+import pandas as pd
+
+# Use pyarrow's multithreaded CSV reader and writer when pyarrow is installed, otherwise pandas' C parser
+try:
+    import pyarrow
+    import pyarrow.csv
+    CSV_ENGINE = "pyarrow"
+except ImportError:
+    CSV_ENGINE = "c"
+
+# Writing Parquet files (DataFrame.to_parquet with engine="pyarrow") needs pyarrow as well
+PARQUET_AVAILABLE = CSV_ENGINE == "pyarrow"
+
+# Optional: JIT-compiles subtract_background_max below when numba is installed
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 # Parse input CSV file to get list of parameters
 def parse_file(infile):
@@ -16,6 +37,78 @@ def parse_file(infile):
         print("parsing parameter file: ", infile)
         with open(infile, newline='') as f:
             reader = csv.reader(f, delimiter=',')
-            param_list = list(reader)[1]
+            # Only the header and the parameter row are parsed; the rest of the file is not read
+            next(reader, None)
+            param_list = next(reader, None)
         print(param_list)
     return param_list
+
+# Row-wise mean and SEM of a 2D float array, ignoring NaN like DataFrame.mean/.sem,
+# computed with NumPy reductions in the array's precision
+def nan_mean_and_sem(values):
+    counts = np.sum(~np.isnan(values), axis=1)
+    with warnings.catch_warnings():
+        # Rows with fewer than two values give NaN, as in pandas, without RuntimeWarnings
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        mean = np.nanmean(values, axis=1)
+        sem = np.nanstd(values, axis=1, ddof=1) / np.sqrt(counts, dtype=values.dtype)
+    return mean, sem
+
+# Subtract background[k] from spot column k of data (time points x spots, float32) in place and
+# return the maximum of each time point, skipping NaN like DataFrame.max(axis=1).
+# Time points with no value in any spot stay NaN.
+def subtract_background_max(data, background):
+    data -= background
+    return np.fmax.reduce(data, axis=1)
+
+# With numba installed, the subtraction and row maximum are compiled into one pass over the array.
+# It runs serially (no prange) because the neuron loops already use one process per core,
+# and without fastmath, which would let the compiler drop the NaN checks.
+if njit is not None:
+    @njit(cache=True)
+    def subtract_background_max(data, background):
+        max_value = np.empty(data.shape[0], dtype=data.dtype)
+        for t in range(data.shape[0]):
+            row_max = np.nan
+            for k in range(data.shape[1]):
+                value = data[t, k] - background[k]
+                data[t, k] = value
+                if value > row_max or row_max != row_max:
+                    row_max = value
+            max_value[t] = row_max
+        return max_value
+
+# Write values into column of data (time points x files) at the rows given by positions (POSITION_T).
+# Rows outside 0..len(data)-1 and non-integral positions are ignored; a repeated position keeps its last value.
+def fill_time_points(data, column, positions, values):
+    in_range = np.isin(positions, np.arange(data.shape[0]))
+    data[positions[in_range].astype(np.intp), column] = values[in_range]
+
+# Read the background values of each neuron from Background_list.csv: one list for each column "Neuron i",
+# i = 0..number_of_neurons-1 (all columns by default). Columns are looked up by name, since the file
+# orders them as text ("Neuron 10" before "Neuron 2"). Non-numeric entries (e.g. the empty cells
+# padding shorter columns) are coerced to NaN and dropped.
+def read_background_list(infile, number_of_neurons=None):
+    background_file = pd.read_csv(infile, keep_default_na=False)
+    if number_of_neurons is None:
+        number_of_neurons = len(background_file.columns)
+    return [pd.to_numeric(background_file[f"Neuron {i}"], errors='coerce').dropna().tolist()
+            for i in range(number_of_neurons)]
+
+# Read only the selected columns of a CSV file with the fastest available engine
+def read_csv_columns(infile, columns, dtype=None):
+    return pd.read_csv(infile, usecols=columns, dtype=dtype, engine=CSV_ENGINE)
+
+# Write a DataFrame (without its index) to a CSV file with the fastest available writer.
+# Missing values are written as empty cells. The header is written by the csv module so that
+# column names are only quoted when needed, as with DataFrame.to_csv.
+def write_csv(df, outfile):
+    if CSV_ENGINE != "pyarrow":
+        df.to_csv(outfile, index=False, na_rep='', lineterminator='\n')
+        return
+    header = io.StringIO()
+    csv.writer(header, lineterminator='\n').writerow(df.columns)
+    with open(outfile, 'wb') as f:
+        f.write(header.getvalue().encode('utf-8'))
+        pyarrow.csv.write_csv(pyarrow.Table.from_pandas(df, preserve_index=False), f,
+                              pyarrow.csv.WriteOptions(include_header=False))